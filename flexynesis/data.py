@@ -1,17 +1,23 @@
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler, BatchSampler, RandomSampler, SequentialSampler
 from torch_geometric.data import Data
 from torch_geometric.data import Dataset as PYGDataset
 
 import numpy as np
 import pandas as pd
 from functools import reduce
+from collections.abc import Mapping
 import torch
 import os
+import json
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 
-from tqdm import tqdm
+try:
+    from pyarrow import csv as pacsv
+except ImportError:
+    pacsv = None
 
-
-from sklearn.preprocessing import OrdinalEncoder, StandardScaler, MinMaxScaler, PowerTransformer
+from sklearn.preprocessing import StandardScaler, MinMaxScaler, PowerTransformer
 from .feature_selection import filter_by_laplacian
 
 from itertools import chain
@@ -20,36 +26,150 @@ from itertools import chain
 class TripletMultiOmicDataset(Dataset):
     """
     For each sample (anchor) randomly chooses a positive and negative samples
+
+    The (positive, negative) pairs are drawn for all samples at once by `precompute_triplets`
+    and redrawn at the start of every epoch via `set_epoch`, so that `__getitem__` only
+    does indexing.
     """
 
-    def __init__(self, mydataset, main_var):
+    def __init__(self, mydataset, main_var, seed=None):
         self.dataset = mydataset
         self.main_var = main_var
+        self.seed = seed
         self.labels_set, self.label_to_indices = self.get_label_indices(self.dataset.ann[self.main_var])
+        self.precompute_triplets(seed)
+
     def __getitem__(self, index):
-        # get anchor sample and its label
-        anchor, y_dict = self.dataset[index][0], self.dataset[index][1] 
-        # choose another sample with same label
-        label = y_dict[self.main_var].item()
-        positive_index = index
-        while positive_index == index:
-            positive_index = np.random.choice(self.label_to_indices[label])
-        # choose another sample with a different label 
-        negative_label = np.random.choice(list(self.labels_set - set([label])))
-        negative_index = np.random.choice(self.label_to_indices[negative_label])
-        pos = self.dataset[positive_index][0] # positive example
-        neg = self.dataset[negative_index][0] # negative example
+        """Get a triplet, or a batch of triplets if `index` is a list/array/tensor of indices.
+
+        The anchor, positive and negative samples are gathered with a single index into the wrapped dataset.
+
+        Returns:
+            A tuple (anchor, pos, neg, y_dict), where y_dict holds the labels of the anchor(s).
+        """
+        index = torch.stack([torch.as_tensor(index), self.pos_idx[index], self.neg_idx[index]])
+        dat, y_dict = self.dataset[index]
+        anchor, pos, neg = ({x: dat[x][i] for x in dat.keys()} for i in range(3))
+        y_dict = {x: y_dict[x][0] for x in y_dict.keys()}
         return anchor, pos, neg, y_dict
 
     def __len__(self):
         return len(self.dataset)
     
     def get_label_indices(self, labels):
-        labels_set = set(labels.numpy())
-        label_to_indices = {label: np.where(labels.numpy() == label)[0]
-                             for label in labels_set}
+        # group the sample indices by label in a single pass (one sort instead of a scan per label);
+        # samples with a missing label (NaN or -1) are not part of any group
+        labels = labels.numpy()
+        known = np.flatnonzero(~np.isnan(labels) & (labels != -1))
+        labels_unique, inverse = np.unique(labels[known], return_inverse=True)
+        order = known[np.argsort(inverse, kind='stable')]
+        groups = np.split(order, np.cumsum(np.bincount(inverse, minlength=len(labels_unique)))[:-1])
+        labels_set = set(labels_unique.tolist())
+        label_to_indices = dict(zip(labels_unique.tolist(), groups))
         return labels_set, label_to_indices   
 
+    def precompute_triplets(self, seed=None):
+        """Draw a positive and a negative sample for every anchor in the dataset.
+
+        Anchors with a missing label are their own positive and negative sample 
+        (they are left out of the triplet loss, see TripletEncoder).
+
+        Args:
+            seed (int, optional): Seed for the random draws. If None, numpy's global random state is used.
+        """
+        rng = np.random if seed is None else np.random.RandomState(seed)
+        groups = list(self.label_to_indices.values())
+        if len(groups) < 2:
+            raise ValueError(f"Triplets require at least two distinct labels in '{self.main_var}'")
+        # samples sorted by label, with the start and size of each label's block
+        members = np.concatenate(groups)
+        sizes = np.array([len(g) for g in groups])
+        starts = np.cumsum(sizes) - sizes
+        # label rank of each labelled sample and its position within its label's block 
+        n = len(self.dataset)
+        labelled = np.sort(members)
+        ranks = np.empty(n, dtype=np.int64)
+        ranks[members] = np.repeat(np.arange(len(groups)), sizes)
+        position = np.empty(n, dtype=np.int64)
+        position[members] = np.arange(len(members)) - np.repeat(starts, sizes)
+        ranks, position = ranks[labelled], position[labelled]
+
+        # choose another sample with same label: draw among the other n-1 members 
+        # and skip over the anchor's own position (a label with a single sample is its own positive)
+        r = rng.randint(0, np.maximum(sizes[ranks] - 1, 1))
+        r = r + (r >= position)
+        r[sizes[ranks] == 1] = 0
+        pos_idx = np.arange(n)
+        pos_idx[labelled] = members[starts[ranks] + r]
+        # choose another sample with a different label (shifting by 1..K-1 skips the anchor's own label)
+        neg_ranks = (rng.randint(len(groups) - 1, size=len(ranks)) + ranks + 1) % len(groups)
+        neg_idx = np.arange(n)
+        neg_idx[labelled] = members[starts[neg_ranks] + rng.randint(0, sizes[neg_ranks])]
+        if getattr(self, 'pos_idx', None) is None:
+            # allocated once in shared memory and updated in place afterwards, 
+            # so that persistent DataLoader workers see the triplets of each new epoch
+            self.pos_idx = torch.from_numpy(pos_idx).share_memory_()
+            self.neg_idx = torch.from_numpy(neg_idx).share_memory_()
+        else:
+            self.pos_idx.copy_(torch.from_numpy(pos_idx))
+            self.neg_idx.copy_(torch.from_numpy(neg_idx))
+
+    def set_epoch(self, epoch):
+        """Redraw the triplets for a new epoch."""
+        self.precompute_triplets(None if self.seed is None else self.seed + epoch)
+
+class PKSampler(Sampler):
+    """
+    Batch sampler that builds each mini-batch from P randomly chosen classes with K samples per class.
+
+    Used for on-the-fly (batch-wise) triplet mining, where every anchor in a batch needs at least
+    one positive and one negative sample from the same batch. Samples with missing labels are never drawn.
+
+    Args:
+        labels (array-like): Class labels of the samples to draw from.
+        p (int): Number of classes per batch (capped by the number of available classes).
+        k (int): Number of samples per class (drawn with replacement for classes smaller than k).
+    """
+    def __init__(self, labels, p, k):
+        labels = np.asarray(labels, dtype=float)
+        valid = np.flatnonzero(~np.isnan(labels) & (labels != -1))
+        self.classes, inverse = np.unique(labels[valid], return_inverse=True)
+        self.class_indices = [valid[inverse == c] for c in range(len(self.classes))]
+        self.p = min(p, len(self.classes))
+        self.k = k
+        self.n_samples = len(valid)
+
+    def __iter__(self):
+        for _ in range(len(self)):
+            classes = np.random.choice(len(self.class_indices), self.p, replace=False)
+            batch = [np.random.choice(self.class_indices[c], self.k, replace=len(self.class_indices[c]) < self.k)
+                     for c in classes]
+            yield np.concatenate(batch).tolist()
+
+    def __len__(self):
+        return max(1, self.n_samples // (self.p * self.k))
+
+
+class _DequantizedDat(Mapping):
+    """Read-only view of the data matrices of a quantized MultiomicDataset.
+
+    Each data matrix is dequantized to float32 only when it is accessed.
+    """
+    def __init__(self, dataset):
+        self._dataset = dataset
+
+    def __getitem__(self, x):
+        s = self._dataset._slices[x]
+        zero, scale = self._dataset._quantization
+        return self._dataset._cat[:, s].float() * scale[s] + zero[s]
+
+    def __iter__(self):
+        return iter(self._dataset._slices)
+
+    def __len__(self):
+        return len(self._dataset._slices)
+
+
 class MultiomicDataset(Dataset):
     """A PyTorch dataset for multiomic data.
 
@@ -74,20 +194,63 @@ class MultiomicDataset(Dataset):
         self.feature_ann = feature_ann or {}
 
     def __getitem__(self, index):
-        """Get a single data sample from the dataset.
+        """Get a single data sample, or a batch of samples, from the dataset.
 
         Args:
-            index (int): The index of the sample to retrieve.
+            index (int or list/array/tensor of int): The index of the sample to retrieve, or the indices of a batch 
+                of samples (all data matrices of the batch are then gathered with a single index into the 
+                concatenated data tensor; see `make_loader`).
 
         Returns:
             A tuple of two elements: 
-                1. A dictionary with keys corresponding to the different types of data in the input dictionary `dat`, and values corresponding to the data for the given sample.
-                2. The label for the given sample.
+                1. A dictionary with keys corresponding to the different types of data in the input dictionary `dat`, and values corresponding to the data for the given sample(s).
+                2. The label(s) for the given sample(s).
         """
-        subset_dat = {x: self.dat[x][index] for x in self.dat.keys()}
+        if isinstance(index, (list, np.ndarray)):
+            index = torch.as_tensor(index)
+        rows = self._dequantize(self._cat[index])
+        subset_dat = {x: rows[..., s] for x, s in self._slices.items()}
         subset_ann = {x: self.ann[x][index] for x in self.ann.keys()}
         return subset_dat, subset_ann
+
+    @property
+    def dat(self):
+        if self._quantization is not None:
+            # data matrices are dequantized one at a time, when accessed
+            return _DequantizedDat(self)
+        return self._dat
+
+    @dat.setter
+    def dat(self, dat):
+        self._quantization = None
+        # keep all data matrices in a single contiguous (samples x all features) tensor, 
+        # each data matrix is a view on its columns
+        offsets = np.cumsum([0] + [dat[x].shape[1] for x in dat.keys()])
+        self._slices = {x: slice(offsets[i], offsets[i+1]) for i, x in enumerate(dat.keys())}
+        tensors = list(dat.values())
+        self._cat = tensors[0].contiguous() if len(tensors) == 1 else torch.cat(tensors, dim=1)
+        self._dat = {x: self._cat[:, s] for x, s in self._slices.items()}
     
+    def quantize(self, zero, scale):
+        """Store the data matrices as 8-bit integers.
+
+        Each feature is affinely quantized to 256 levels as round((x - zero) / scale). Samples are 
+        dequantized back to float32 when fetched, so that batches are gathered from a 4x smaller tensor.
+
+        Args:
+            zero (torch.Tensor): Per-feature offset (e.g. minimum value in the training data).
+            scale (torch.Tensor): Per-feature step size (e.g. value range in the training data / 255).
+        """
+        self._cat = ((self._cat - zero) / scale).round_().clamp_(0, 255).to(torch.uint8)
+        self._dat = {x: self._cat[:, s] for x, s in self._slices.items()}
+        self._quantization = (zero, scale)
+
+    def _dequantize(self, x):
+        if self._quantization is None:
+            return x
+        zero, scale = self._quantization
+        return x.float() * scale + zero
+
     def __len__ (self):
         """Get the total number of samples in the dataset.
 
@@ -132,7 +295,7 @@ class MultiomicDataset(Dataset):
         return result
     
     def get_dataset_stats(self):
-        stats = {': '.join(['feature_count in', x]): self.dat[x].shape[1] for x in self.dat.keys()}
+        stats = {': '.join(['feature_count in', x]): int(s.stop - s.start) for x, s in self._slices.items()}
         stats['sample_count'] = len(self.samples)
         return(stats)
 
@@ -193,6 +356,105 @@ class MultiomicPYGDataset(MultiomicDataset, PYGDataset):
         return self.__len__()
 
 
+def make_loader(dataset, batch_size, shuffle=True, num_workers=None):
+    """Create a DataLoader that fetches whole batches with a single index into the dataset.
+
+    The indices of each batch are drawn by a BatchSampler and the dataset is indexed with the list of 
+    indices (automatic batching is disabled), so that datasets supporting list indices, such as 
+    MultiomicDataset and TripletMultiOmicDataset, gather a batch with one index operation instead of 
+    one `__getitem__` call per sample. With worker processes, batches are prepared in parallel to the 
+    training steps and prefetched; if a GPU is available, they are put in pinned memory for faster transfer.
+
+    Args:
+        dataset (Dataset): The dataset to load (e.g. MultiomicDataset or TripletMultiOmicDataset).
+        batch_size (int): The batch size.
+        shuffle (bool): Whether to shuffle the samples; incomplete last batches are dropped when shuffling. Default is True.
+        num_workers (int, optional): The number of worker processes (0 loads the data in the main process). 
+            Default is half of the available CPUs (at least 2).
+
+    Returns:
+        DataLoader: The data loader.
+
+    Note:
+        The workers are persistent, i.e. each worker keeps its own copy of the dataset across epochs. 
+        Changes made to the dataset in the main process after the first epoch started are only seen by 
+        the workers if they are made in place on shared-memory tensors, as done by 
+        `TripletMultiOmicDataset.set_epoch`.
+    """
+    if num_workers is None:
+        num_workers = max(2, (os.cpu_count() or 1) // 2)
+    sampler = BatchSampler(RandomSampler(dataset) if shuffle else SequentialSampler(dataset), batch_size, drop_last=shuffle)
+    return DataLoader(dataset, sampler=sampler, batch_size=None, 
+                      num_workers=num_workers, pin_memory=torch.cuda.is_available(), 
+                      persistent_workers=num_workers > 0, prefetch_factor=4 if num_workers > 0 else None)
+
+
+def read_data_matrix(fname, use_cache=False):
+    """Read a numerical data matrix (features on rows, samples on columns) from a csv file as float32.
+
+    Uses the multithreaded csv reader of pyarrow if it is installed, otherwise pandas.read_csv.
+
+    Args:
+        fname (str): Path to the csv file.
+        use_cache (bool): If True, the parsed matrix is saved next to the csv file (as <fname>.f32.npy and 
+            <fname>.meta.json) and memory-mapped instead of re-parsing the csv in subsequent calls,
+            as long as the csv file is not modified. Default is False.
+
+    Returns:
+        pd.DataFrame: The data matrix.
+    """
+    cache_path, meta_path = fname + '.f32.npy', fname + '.meta.json'
+    mtime = os.path.getmtime(fname)
+    if use_cache and os.path.exists(cache_path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta['mtime'] == mtime:
+            arr = np.load(cache_path, mmap_mode='r')
+            index = pd.Index(meta['index'], name=meta['index_name'])
+            return pd.DataFrame(arr, index=index, columns=meta['columns'], copy=False)
+
+    if pacsv is None:
+        df = pd.read_csv(fname, index_col=0)
+    else:
+        df = pacsv.read_csv(fname).to_pandas(self_destruct=True)
+        # rename duplicate column names as pandas.read_csv does
+        df.columns = _dedup_names(df.columns)
+        df = df.set_index(df.columns[0])
+        if df.index.name == '':
+            df.index.name = None
+    # single precision is enough for the data matrices and halves their memory footprint
+    df = df.astype(np.float32)
+
+    if use_cache:
+        try:
+            np.save(cache_path, np.ascontiguousarray(df.values))
+            with open(meta_path, 'w') as f:
+                json.dump({'mtime': mtime, 'index': df.index.tolist(), 'index_name': df.index.name, 
+                           'columns': df.columns.tolist()}, f)
+        except OSError as e:
+            print(f"[WARNING] Could not cache {fname}: {e}")
+    return df
+
+
+def _dedup_names(names):
+    """Rename duplicate names the way pandas.read_csv does: the second "x" becomes "x.1", the third "x.2", etc. 
+    (skipping names that are already in use)."""
+    names = list(names)
+    header = set(names)
+    counts = {}
+    for i, name in enumerate(names):
+        count = counts.get(name, 0)
+        if count > 0:
+            new_name = name
+            while count > 0:
+                counts[name] = count + 1
+                new_name = f"{name}.{count}"
+                count = count + 1 if new_name in header else counts.get(new_name, 0)
+            names[i] = new_name
+        counts[names[i]] = counts.get(names[i], 0) + 1
+    return names
+
+
 def read_stringdb_links(fname):
     df = pd.read_csv(fname, header=0, sep=" ")
     df = df[df.combined_score > 400]
@@ -246,7 +508,8 @@ class DataImporter:
     protein_aliases = "9606.protein.aliases.v12.0.txt"
 
     def __init__(self, path, data_types, log_transform = False, concatenate = False, min_features=None, 
-                 top_percentile=None, variance_threshold=1e-5, na_threshold=0.1, use_graph=False, node_name="gene_name", transform=None):
+                 top_percentile=None, variance_threshold=1e-5, na_threshold=0.1, use_graph=False, node_name="gene_name", transform=None,
+                 cache_data=False, quantize=False):
         self.path = path
         self.data_types = data_types
         self.concatenate = concatenate
@@ -259,22 +522,35 @@ class DataImporter:
         self.encoders = {} # used if labels are categorical 
         # initialize data scalers
         self.scalers = None
+        self.scaling_factors = None
+        # feature variances computed during data cleanup
+        self.feature_variances = {}
         # initialize data transformers
         self.transformers = None
 
         self.use_graph = use_graph
         self.node_name = node_name  # "gene_name" | "gene_id"
         self.transform = transform
+        # whether to cache parsed data matrices next to the csv files (see read_data_matrix)
+        self.cache_data = cache_data
+        # whether to store early-fused (concatenated) data as 8-bit integers (see MultiomicDataset.quantize)
+        self.quantize = quantize
         
     def read_data(self, folder_path):
         data = {}
         required_files = {'clin.csv'} | {f"{dt}.csv" for dt in self.data_types}
         print("\n[INFO] ----------------- Reading Data -----------------")
-        for file in required_files:
-            file_path = os.path.join(folder_path, file)
-            file_name = os.path.splitext(file)[0]
-            print(f"[INFO] Importing {file_path}...")
-            data[file_name] = pd.read_csv(file_path, index_col=0)
+        # read the files in parallel
+        with ThreadPoolExecutor(max_workers=len(required_files)) as executor:
+            for file in required_files:
+                file_path = os.path.join(folder_path, file)
+                file_name = os.path.splitext(file)[0]
+                print(f"[INFO] Importing {file_path}...")
+                if file_name == 'clin':
+                    data[file_name] = executor.submit(pd.read_csv, file_path, index_col=0)
+                else:
+                    data[file_name] = executor.submit(read_data_matrix, file_path, self.cache_data)
+            data = {x: data[x].result() for x in data.keys()}
         return data
 
     def read_graph(self, fname=None):
@@ -287,61 +563,76 @@ class DataImporter:
         print("\n[INFO] --------------- Cleaning Up Data ---------------")
         cleaned_dfs = {}
         sample_masks = []
+        # samples shared by all data matrices; the sample masks are aligned to this order
+        common_samples = reduce(lambda a, b: a.intersection(b), [df.columns for df in df_dict.values()])
 
         # First pass: remove near-zero-variation features and create masks for informative samples
         for key, df in df_dict.items():
             original_features_count = df.shape[0]
 
+            # Compute the NA mask once, and reuse it for variance, NA percentage and imputation steps
+            arr = df.values
+            na_mask = np.isnan(arr)
+
             # Step 1: Remove near-zero-variation features
-            # Compute variances of features (along rows)
-            feature_variances = df.var(axis=1)
-            # Keep only features with variance above the threshold
-            df = df.loc[feature_variances > self.variance_threshold, :]
+            # Compute variances of features (along rows), ignoring NA values
+            with warnings.catch_warnings():
+                # features with all/all-but-one NA values get a NA variance, and are removed 
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                feature_variances = np.nanvar(arr, axis=1, ddof=1)
             
             # Step 2: Remove features with too many NA values
             # Compute percentage of NA values for each feature
-            na_percentages = df.isna().mean(axis=1)
-            # Keep only features with percentage of NA values below the threshold
-            df = df.loc[na_percentages < self.na_threshold, :]
+            na_percentages = na_mask.mean(axis=1)
+
+            # Keep only features with variance above the threshold and percentage of NA values below the threshold
+            keep = (feature_variances > self.variance_threshold) & (na_percentages < self.na_threshold)
+            df = df.loc[keep, :]
+            na_mask = na_mask[keep]
+            # keep the variances of the remaining features for the feature selection step (see filter)
+            self.feature_variances[key] = pd.Series(feature_variances[keep], index=df.index)
             
             # Step 3: Fill NA values with the median of the feature
             # Check if there are any NA values in the DataFrame
-            
-            if np.sum(df.isna().sum()) > 0:
+            if na_mask.any():
                 # Identify rows that contain missing values
-                missing_rows = df.isna().any(axis=1)
-                print("Imputing NA values to median of features, affected # of features ", np.sum(df.isna().sum()), " # of rows:",sum(missing_rows))
+                missing_rows = na_mask.any(axis=1)
+                print("Imputing NA values to median of features, affected # of features ", na_mask.sum(), " # of rows:",missing_rows.sum())
 
                 # Only calculate the median for rows with missing values
-                medians = df[missing_rows].median(axis=1)
+                medians = df.loc[missing_rows].median(axis=1).reindex(df.index)
 
-                # Iterate over the index using tqdm to display a progress bar
-                for i in tqdm(medians.index):
-                    # Replace missing values in the row with the corresponding median
-                    df.loc[i] = df.loc[i].fillna(medians[i])
+                # Replace missing values in each row with the corresponding median
+                df = df.mask(na_mask, medians, axis=0)
                     
-            print("Number of NA values: ",np.sum(df.isna().sum()))
+            print("Number of NA values: ",df.isna().values.sum())
                                    
             removed_features_count = original_features_count - df.shape[0]
             print(f"[INFO] DataFrame {key} - Removed {removed_features_count} features.")
         
             # Step 2: Create masks for informative samples
             # Compute standard deviation of samples (along columns)
-            sample_stdevs = df.std(axis=0)
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                sample_stdevs = np.nanstd(df.values, axis=0, ddof=1)
             # Create mask for samples that do not have std dev of 0 or NaN
             mask = np.logical_and(sample_stdevs != 0, np.logical_not(np.isnan(sample_stdevs)))
-            sample_masks.append(mask)
+            sample_masks.append(mask[df.columns.get_indexer(common_samples)])
 
             cleaned_dfs[key] = df
 
         # Find samples that are informative in all dataframes
-        common_mask = pd.DataFrame(sample_masks).all()
+        common_mask = np.logical_and.reduce(sample_masks)
+        informative_samples = common_samples[common_mask]
 
         # Second pass: apply common mask to all dataframes
-        for key in cleaned_dfs.keys():
-            original_samples_count = cleaned_dfs[key].shape[1]
-            cleaned_dfs[key] = cleaned_dfs[key].loc[:, common_mask]
-            removed_samples_count = original_samples_count - cleaned_dfs[key].shape[1]
+        for key, df in cleaned_dfs.items():
+            original_samples_count = df.shape[1]
+            keep = np.flatnonzero(df.columns.isin(informative_samples))
+            # skip the copy if all samples are kept 
+            if keep.size < original_samples_count:
+                cleaned_dfs[key] = pd.DataFrame(df.values[:, keep], index=df.index, columns=df.columns[keep])
+            removed_samples_count = original_samples_count - keep.size
             print(f"DataFrame {key} - Removed {removed_samples_count} samples ({removed_samples_count / original_samples_count * 100:.2f}%).")
 
         return cleaned_dfs
@@ -445,22 +736,32 @@ class DataImporter:
             train_dat = self.transform_data(train_dat)
             test_dat = self.transform_data(test_dat)
         
-        # Normalize the training data (for testing data, use normalisation factors
-        # learned from training data to apply on test data (see fit = False)
-        train_dat = self.normalize_data(train_dat, scaler_type="standard", fit=True)
-        test_dat = self.normalize_data(test_dat, scaler_type="standard", fit=False)
+        # Learn normalisation factors from the training data; these are applied on both training 
+        # and testing data while converting them to tensors (see get_torch_dataset)
+        self.fit_scalers(train_dat, scaler_type="standard")
         
         # encode the variable annotations, convert data matrices and annotations pytorch datasets 
         training_dataset = self.get_torch_dataset(train_dat, train_ann, train_samples, train_feature_ann)
         testing_dataset = self.get_torch_dataset(test_dat, test_ann, test_samples, test_feature_ann)
        
         # for early fusion, concatenate all data matrices and feature lists 
+        # (the datasets already store their data matrices concatenated in a single tensor, 
+        # which is reused without copying)
         if self.concatenate:
-            training_dataset.dat = {'all': torch.cat([training_dataset.dat[x] for x in training_dataset.dat.keys()], dim = 1)}
+            training_dataset.dat = {'all': training_dataset._cat}
             training_dataset.features = {'all': list(chain(*training_dataset.features.values()))}
             
-            testing_dataset.dat = {'all': torch.cat([testing_dataset.dat[x] for x in testing_dataset.dat.keys()], dim = 1)}
+            testing_dataset.dat = {'all': testing_dataset._cat}
             testing_dataset.features = {'all': list(chain(*testing_dataset.features.values()))}
+
+            if self.quantize:
+                # per-feature quantization ranges are learned from the (normalized) training data 
+                x = training_dataset._cat
+                zero = x.min(dim=0).values
+                scale = (x.max(dim=0).values - zero) / 255
+                scale[scale == 0] = 1 # constant features
+                training_dataset.quantize(zero, scale)
+                testing_dataset.quantize(zero, scale)
         
         print("[INFO] Training Data Stats:\n", training_dataset.get_dataset_stats())
         print("[INFO] Test Data Stats:\n", testing_dataset.get_dataset_stats())
@@ -502,11 +803,11 @@ class DataImporter:
 
     def get_labels(self, dat, ann):
         # subset samples and reorder annotations for the samples 
-        samples = list(reduce(set.intersection, [set(item) for item in [dat[x].columns for x in dat.keys()]]))
-        samples = list(set(ann.index).intersection(samples))
-        dat = {x: dat[x][samples] for x in dat.keys()}
-        ann = ann.loc[samples]
-        return dat, ann, samples
+        samples = reduce(lambda a, b: a.intersection(b), [dat[x].columns for x in dat.keys()] + [ann.index])
+        # only reorder/subset the matrices whose samples differ from the common samples
+        dat = {x: dat[x] if dat[x].columns.equals(samples) else dat[x].reindex(columns=samples) for x in dat.keys()}
+        ann = ann.reindex(samples)
+        return dat, ann, samples.tolist()
 
     def encode_labels(self, df):
         label_mappings = {}
@@ -514,17 +815,20 @@ class DataImporter:
             nonlocal label_mappings  # Declare as nonlocal so that we can modify it
             # Fill NA values with 'missing' 
             # series = series.fillna('missing')
+            # pd.Categorical factorizes in C; the fitted categories are reused for transform, 
+            # so categories unseen during fit are encoded as -1 
             if series.name not in self.encoders:
-                self.encoders[series.name] = OrdinalEncoder(handle_unknown='use_encoded_value', unknown_value=-1)
-                encoded_series = self.encoders[series.name].fit_transform(series.to_frame())
+                cat = pd.Categorical(series)
+                self.encoders[series.name] = cat.categories
             else:
-                encoded_series = self.encoders[series.name].transform(series.to_frame())
+                cat = pd.Categorical(series, categories=self.encoders[series.name])
+            encoded_series = cat.codes.astype(np.float64)
+            # keep missing values as NaN (rather than -1) so that they are still treated as missing downstream
+            encoded_series[series.isna().values] = np.nan
             
             # also save label mappings 
-            label_mappings[series.name] = {
-                    int(code): label for code, label in enumerate(self.encoders[series.name].categories_[0])
-                }
-            return encoded_series.ravel()
+            label_mappings[series.name] = dict(enumerate(self.encoders[series.name]))
+            return encoded_series
 
         # Select only the categorical columns
         df_categorical = df.select_dtypes(include=['object', 'category']).apply(encode_column)
@@ -540,7 +844,11 @@ class DataImporter:
 
     def get_torch_dataset(self, dat, ann, samples, feature_ann):
         features = {x: dat[x].index for x in dat.keys()}
-        dat = {x: torch.from_numpy(np.array(dat[x].T)).float() for x in dat.keys()}
+        # build each (samples x features) float32 tensor with a single copy; the copy also guarantees 
+        # that the in-place normalization below never writes into the source data frames
+        dat = {x: torch.from_numpy(np.array(dat[x].values.T, dtype=np.float32, order='C')) for x in dat.keys()}
+        if self.scaling_factors is not None:
+            dat = self.normalize_data(dat)
 
         ann, variable_types, label_mappings = self.encode_labels(ann)
 
@@ -551,32 +859,54 @@ class DataImporter:
         else:
             return MultiomicPYGDataset(dat, ann, variable_types, features, samples, label_mappings, feature_ann, transform=self.transform)
     
-    def normalize_data(self, data, scaler_type="standard", fit=True):
+    def fit_scalers(self, data, scaler_type="standard"):
         print("\n[INFO] --------------- Normalizing Data ---------------")
-        # notice matrix transpositions during fit and finally after transformation
+        # notice matrix transpositions during fit 
         # because data matrices have features on rows, 
         # while scaling methods assume features to be on the columns. 
-        if fit:
-            if scaler_type == "standard":
-                self.scalers = {x: StandardScaler().fit(data[x].T) for x in data.keys()}
-            elif scaler_type == "min_max":
-                self.scalers = {x: MinMaxScaler().fit(data[x].T) for x in data.keys()}
-            else:
-                raise ValueError("Invalid scaler_type. Choose 'standard' or 'min_max'.")
-        
-        normalized_data = {x: pd.DataFrame(self.scalers[x].transform(data[x].T), 
-                                           index=data[x].columns, 
-                                           columns=data[x].index).T 
-                           for x in data.keys()}
-        return normalized_data
+        if scaler_type == "standard":
+            self.scalers = {x: StandardScaler().fit(data[x].T.values) for x in data.keys()}
+            factors = {x: (scaler.mean_, scaler.scale_) for x, scaler in self.scalers.items()}
+        elif scaler_type == "min_max":
+            self.scalers = {x: MinMaxScaler().fit(data[x].T.values) for x in data.keys()}
+            # MinMaxScaler transforms as x * scale_ + min_
+            factors = {x: (-scaler.min_ / scaler.scale_, 1 / scaler.scale_) for x, scaler in self.scalers.items()}
+        else:
+            raise ValueError("Invalid scaler_type. Choose 'standard' or 'min_max'.")
+        # keep the normalisation factors as tensors, so that they can be applied directly 
+        # on the data tensors as (x - center) / scale (see normalize_data)
+        self.scaling_factors = {x: (torch.tensor(center, dtype=torch.float32), torch.tensor(scale, dtype=torch.float32)) 
+                                for x, (center, scale) in factors.items()}
+
+    def normalize_data(self, dat):
+        # dat: dictionary of tensors with samples on rows and features on columns; normalised in place
+        for x in dat.keys():
+            center, scale = self.scaling_factors[x]
+            dat[x].sub_(center).div_(scale)
+        return dat
     
     def transform_data(self, data):
         transformed_data = {x: np.log1p(data[x].T).T for x in data.keys()}
         return transformed_data    
 
-    def filter(self, dat, min_features, top_percentile):
+    def filter(self, dat, min_features, top_percentile, prefilter_factor=5):
         counts = {x: max(int(dat[x].shape[0] * top_percentile / 100), min_features) for x in dat.keys()}
-        dat = {x: filter_by_laplacian(dat[x].T, x, topN=counts[x]).T for x in dat.keys()}
+        # laplacian scoring is expensive for many features, so only the (prefilter_factor x topN) 
+        # most variable features of each data matrix are scored 
+        candidates = {}
+        for x in dat.keys():
+            n_candidates = prefilter_factor * counts[x]
+            if n_candidates < dat[x].shape[0]:
+                if x in self.feature_variances:
+                    variances = self.feature_variances[x].reindex(dat[x].index).values
+                else:
+                    # data not passed through cleanup_data: compute the variances here
+                    variances = dat[x].var(axis=1).values
+                top_idx = np.sort(np.argpartition(-variances, n_candidates)[:n_candidates])
+                candidates[x] = dat[x].iloc[top_idx]
+            else:
+                candidates[x] = dat[x]
+        dat = {x: filter_by_laplacian(candidates[x].T, x, topN=counts[x]).T for x in candidates.keys()}
         return dat
 
     def harmonize(self, dat1, dat2):
@@ -584,8 +914,8 @@ class DataImporter:
         # Get common features
         common_features = {x: dat1[x].index.intersection(dat2[x].index) for x in self.data_types}
         # Subset both datasets to only include common features
-        dat1 = {x: dat1[x].loc[common_features[x]] for x in dat1.keys()}
-        dat2 = {x: dat2[x].loc[common_features[x]] for x in dat2.keys()}
+        dat1 = {x: dat1[x].reindex(common_features[x]) for x in dat1.keys()}
+        dat2 = {x: dat2[x].reindex(common_features[x]) for x in dat2.keys()}
         return dat1, dat2
     
 
@@ -594,9 +924,11 @@ def split_by_median(tensor_dict):
     for key, tensor in tensor_dict.items():
         # Check if the tensor is of a floating point type (i.e., it's numerical)
         if tensor.dtype in {torch.float16, torch.float32, torch.float64}:
-            # Remove NaNs and compute median
-            tensor_no_nan = tensor[torch.isfinite(tensor)]
-            median_val = tensor_no_nan.sort().values[tensor_no_nan.numel() // 2]
+            # Compute the median of the finite values by selection (kthvalue) rather than a full sort: 
+            # non-finite values are pushed to the end, so the k-th smallest value is among the finite ones
+            finite = torch.isfinite(tensor)
+            values = torch.where(finite, tensor, torch.full_like(tensor, float('inf'))).flatten()
+            median_val = values.kthvalue(int(finite.sum()) // 2 + 1).values
             
             # Convert to categorical, but preserve NaNs
             tensor_cat = (tensor > median_val).float()
@@ -12,6 +12,7 @@ from captum.attr import IntegratedGradients
 
 
 from ..modules import CNN
+from ..data import make_loader
 
 
 class DirectPredCNN(pl.LightningModule):
@@ -125,19 +126,10 @@ class DirectPredCNN(pl.LightningModule):
         return dat_train, dat_val
 
     def train_dataloader(self):
-        return DataLoader(
-            self.dat_train,
-            batch_size=int(self.config["batch_size"]),
-            num_workers=0,
-            pin_memory=True,
-            shuffle=True,
-            drop_last=True,
-        )
+        return make_loader(self.dat_train, int(self.config["batch_size"]), shuffle=True, num_workers=0)
 
     def val_dataloader(self):
-        return DataLoader(
-            self.dat_val, batch_size=int(self.config["batch_size"]), num_workers=0, pin_memory=True, shuffle=False
-        )
+        return make_loader(self.dat_val, int(self.config["batch_size"]), shuffle=False, num_workers=0)
 
     def predict(self, dataset):
         self.eval()
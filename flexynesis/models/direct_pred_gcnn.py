@@ -68,7 +68,7 @@ class DirectPredGCNN(pl.LightningModule):
         embeddings_list = []
         # Process each input matrix with its corresponding Encoder
         for i, x in enumerate(x_list):
-            embeddings_list.append(self.encoders[i](x.x, x.edge_index, x.batch))
+            embeddings_list.append(self.encoders[i](x.x, x.edge_index, x.batch, x.num_graphs))
         embeddings_concat = torch.cat(embeddings_list, dim=1)
 
         outputs = {}
@@ -211,7 +211,7 @@ class DirectPredGCNN(pl.LightningModule):
         embeddings_list = []
         # Process each input matrix with its corresponding Encoder
         for i, x in enumerate(inputs):
-            embeddings_list.append(self.encoders[i](x.x, x.edge_index, x.batch))
+            embeddings_list.append(self.encoders[i](x.x, x.edge_index, x.batch, x.num_graphs))
         embeddings_concat = torch.cat(embeddings_list, dim=1)
 
         # Converting tensor to numpy array and then to DataFrame
@@ -14,6 +14,7 @@ from scipy import stats
 from captum.attr import IntegratedGradients
 
 from ..modules import *
+from ..data import make_loader
 
 # Supervised Variational Auto-encoder that can train one or more layers of omics datasets 
 # num_layers: number of omics layers in the input
@@ -258,10 +259,10 @@ class supervised_vae(pl.LightningModule):
         return dat_train, dat_val
     
     def train_dataloader(self):
-        return DataLoader(self.dat_train, batch_size=int(self.config['batch_size']), num_workers=0, pin_memory=True, shuffle=True, drop_last=True)
+        return make_loader(self.dat_train, int(self.config['batch_size']), shuffle=True, num_workers=0)
 
     def val_dataloader(self):
-        return DataLoader(self.dat_val, batch_size=int(self.config['batch_size']), num_workers=0, pin_memory=True, shuffle=False)
+        return make_loader(self.dat_val, int(self.config['batch_size']), shuffle=False, num_workers=0)
         
     def transform(self, dataset):
         """
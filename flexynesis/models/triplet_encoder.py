@@ -12,7 +12,7 @@ import numpy as np
 import pytorch_lightning as pl
 
 from ..modules import *
-from ..data import TripletMultiOmicDataset
+from ..data import TripletMultiOmicDataset, PKSampler, make_loader
 
 from captum.attr import IntegratedGradients
 
@@ -59,6 +59,14 @@ class MultiEmbeddingNetwork(nn.Module):
 
 class MultiTripletNetwork(pl.LightningModule):
     """
+    A multi-omic embedding network trained with a triplet loss on the first target variable,
+    and supervisor heads (MLPs) for all target and batch variables.
+
+    Triplets are formed in one of two ways, set by the optional `triplet_mining` entry of the config:
+        - 'random' (default): for each anchor, a random positive and negative sample is drawn by
+          TripletMultiOmicDataset.
+        - 'semi-hard': mini-batches of P classes x K samples are drawn by PKSampler and the triplets
+          are mined on the embeddings of each batch (hardest positive, semi-hard negative).
     """
     def __init__(self, config, dataset, target_variables, batch_variables = None, val_size = 0.2, use_loss_weighting = True):
         """
@@ -99,6 +107,11 @@ class MultiTripletNetwork(pl.LightningModule):
                 self.log_vars[loss_type] = nn.Parameter(torch.zeros(1))
         
         
+        self.main_var = main_var
+        self.triplet_mining = config.get('triplet_mining', 'random')
+        if self.triplet_mining not in ['random', 'semi-hard']:
+            raise ValueError(f"Invalid triplet_mining: {self.triplet_mining}. Choose 'random' or 'semi-hard'.")
+        
         # create train/validation splits and convert TripletMultiOmicDataset format
         self.dataset = TripletMultiOmicDataset(self.dataset, main_var)
         self.dat_train, self.dat_val = self.prepare_data() 
@@ -201,10 +214,70 @@ class MultiTripletNetwork(pl.LightningModule):
             total_loss = sum(losses.values())
         return total_loss
 
+    def mine_triplets(self, embeddings, labels):
+        """
+        Mine triplets within a batch of embeddings: for each anchor, pick the hardest positive
+        (furthest sample with the same label) and the semi-hard negative (closest sample with a 
+        different label that is further away than the positive). If an anchor has no semi-hard 
+        negative, the hardest negative (closest sample with a different label) is used.
+
+        Args:
+            embeddings (torch.Tensor): The embeddings of the batch (batch_size, embedding_dim).
+            labels (torch.Tensor): The labels of the main variable for the batch.
+
+        Returns:
+            tuple: Indices of the positive and negative samples for each anchor, 
+                   and a boolean mask of anchors for which a valid triplet exists.
+        """
+        with torch.no_grad():
+            dist = torch.cdist(embeddings, embeddings)
+            known = (labels != -1) & (~torch.isnan(labels))
+            same = labels[:, None] == labels[None, :]
+            pos_mask = same & ~torch.eye(len(labels), dtype=torch.bool, device=labels.device)
+            neg_mask = ~same & known[None, :]
+            dist_ap, pos = dist.masked_fill(~pos_mask, -float('inf')).max(1)
+            dist_an, neg = dist.masked_fill(~neg_mask | (dist <= dist_ap[:, None]), float('inf')).min(1)
+            hardest_neg = dist.masked_fill(~neg_mask, float('inf')).argmin(1)
+            neg = torch.where(torch.isinf(dist_an), hardest_neg, neg)
+            valid = known & pos_mask.any(1) & neg_mask.any(1)
+        return pos, neg, valid
+
+    def compute_triplet_step(self, batch):
+        """
+        Compute the embeddings, the triplet loss, and the supervisor outputs for a batch.
+
+        Args:
+            batch: A batch of (anchor, positive, negative, y_dict) for 'random' mining or 
+                   (dat, y_dict) for 'semi-hard' mining.
+
+        Returns:
+            tuple: The triplet loss, the supervisor outputs, and the labels of the anchors.
+        """
+        if self.triplet_mining == 'semi-hard':
+            dat, y_dict = batch[0], batch[1]
+            anchor_embedding = self.multi_embedding_network(dat)
+            outputs = {var: mlp(anchor_embedding) for var, mlp in self.MLPs.items()}
+            pos, neg, valid = self.mine_triplets(anchor_embedding, y_dict[self.main_var])
+            if valid.any():
+                triplet_loss = self.triplet_loss(anchor_embedding[valid], anchor_embedding[pos[valid]], 
+                                                 anchor_embedding[neg[valid]])
+            else:
+                triplet_loss = torch.tensor(0.0, device=anchor_embedding.device, requires_grad=True)
+        else:
+            anchor, positive, negative, y_dict = batch[0], batch[1], batch[2], batch[3]
+            anchor_embedding, positive_embedding, negative_embedding, outputs = self.forward(anchor, positive, negative)
+            # anchors with a missing label have no triplet (see TripletMultiOmicDataset.precompute_triplets)
+            labels = y_dict[self.main_var]
+            valid = (labels != -1) & (~torch.isnan(labels))
+            if valid.any():
+                triplet_loss = self.triplet_loss(anchor_embedding[valid], positive_embedding[valid], 
+                                                 negative_embedding[valid])
+            else:
+                triplet_loss = torch.tensor(0.0, device=anchor_embedding.device, requires_grad=True)
+        return triplet_loss, outputs, y_dict
+
     def training_step(self, train_batch, batch_idx):
-        anchor, positive, negative, y_dict = train_batch[0], train_batch[1], train_batch[2], train_batch[3]
-        anchor_embedding, positive_embedding, negative_embedding, outputs = self.forward(anchor, positive, negative)
-        triplet_loss = self.triplet_loss(anchor_embedding, positive_embedding, negative_embedding)
+        triplet_loss, outputs, y_dict = self.compute_triplet_step(train_batch)
         
         # compute loss values for the supervisor heads 
         losses = {'triplet_loss': triplet_loss}
@@ -221,9 +294,7 @@ class MultiTripletNetwork(pl.LightningModule):
         return total_loss
     
     def validation_step(self, val_batch, batch_idx):
-        anchor, positive, negative, y_dict = val_batch[0], val_batch[1], val_batch[2], val_batch[3]
-        anchor_embedding, positive_embedding, negative_embedding, outputs = self.forward(anchor, positive, negative)
-        triplet_loss = self.triplet_loss(anchor_embedding, positive_embedding, negative_embedding)
+        triplet_loss, outputs, y_dict = self.compute_triplet_step(val_batch)
         
         # compute loss values for the supervisor heads 
         losses = {'triplet_loss': triplet_loss}
@@ -238,18 +309,32 @@ class MultiTripletNetwork(pl.LightningModule):
         self.log_dict(losses, on_step=False, on_epoch=True, prog_bar=True)
         return total_loss
     
+    def on_train_epoch_start(self):
+        # draw new positive/negative samples for each anchor
+        if self.triplet_mining == 'random':
+            self.dataset.set_epoch(self.current_epoch)
+
     def prepare_data(self):
-        lt = int(len(self.dataset)*(1-self.val_size))
-        lv = len(self.dataset)-lt
-        dat_train, dat_val = random_split(self.dataset, [lt, lv], 
+        # for semi-hard mining, the triplets are formed within batches, 
+        # so split the underlying MultiomicDataset instead
+        dataset = self.dataset.dataset if self.triplet_mining == 'semi-hard' else self.dataset
+        lt = int(len(dataset)*(1-self.val_size))
+        lv = len(dataset)-lt
+        dat_train, dat_val = random_split(dataset, [lt, lv], 
                                           generator=torch.Generator().manual_seed(42))
         return dat_train, dat_val
 
     def train_dataloader(self):
-        return DataLoader(self.dat_train, batch_size=int(self.config['batch_size']), num_workers=0, pin_memory=True, shuffle=True, drop_last=True)
+        if self.triplet_mining == 'semi-hard':
+            # batches of P classes x K samples per class
+            k = 4
+            p = max(2, int(self.config['batch_size']) // k)
+            labels = self.ann[self.main_var][self.dat_train.indices]
+            return DataLoader(self.dat_train, sampler=PKSampler(labels, p, k), batch_size=None, num_workers=0, pin_memory=True)
+        return make_loader(self.dat_train, int(self.config['batch_size']), shuffle=True, num_workers=0)
 
     def val_dataloader(self):
-        return DataLoader(self.dat_val, batch_size=int(self.config['batch_size']), num_workers=0, pin_memory=True, shuffle=False)    
+        return make_loader(self.dat_val, int(self.config['batch_size']), shuffle=False, num_workers=0)
         
     # dataset: MultiOmicDataset
     def transform(self, dataset):
@@ -1,5 +1,7 @@
 # Networks that can be reused across different architectures
 
+import contextlib
+
 import torch
 from torch import nn
 import torch_geometric.nn as gnn
@@ -8,37 +10,161 @@ import torch_geometric.nn as gnn
 __all__ = ["Encoder", "Decoder", "MLP", "EmbeddingNetwork", "CNN", "GCNN"]
 
 
+def _compile_forward(module):
+    """
+    Compile the forward pass of a module with torch.compile.
+
+    Uses `nn.Module.compile` (torch >= 2.2), or on older torch versions replaces the bound forward 
+    method of the module with its compiled version. Either way, the state_dict keys stay the same 
+    as for the eager module, and the module can still be pickled with torch.save (the compiled 
+    forward is not saved, see `_getstate_eager`, so a loaded module runs eagerly).
+    """
+    if hasattr(nn.Module, "compile"):
+        module.compile()
+    else:
+        module.forward = torch.compile(module.forward)
+    return module
+
+
+def _getstate_eager(module):
+    # __getstate__ of modules that can be compiled with _compile_forward: 
+    # the compiled forward cannot be pickled, so it is left out of the saved state
+    state = module.__dict__.copy()
+    state.pop("forward", None)
+    state.pop("_compiled_call_impl", None)
+    return state
+
+
+def _round_up(d, m=8):
+    """Round a layer width `d` up to the nearest multiple of `m`."""
+    return -(-d // m) * m
+
+
+def _autocast(x, amp_dtype):
+    """
+    Mixed precision context for the forward pass of a module on input `x`.
+
+    Runs the enclosed ops under torch.autocast with `amp_dtype` (e.g. torch.bfloat16 or torch.float16) 
+    on the device of `x`. If `amp_dtype` is None, this is a no-op context that leaves any enclosing 
+    autocast (e.g. Lightning's precision="16-mixed") in effect.
+    """
+    if amp_dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(x.device.type, dtype=amp_dtype)
+
+
+def _bn_affine(bn):
+    # in eval mode, batch norm is the per-feature affine map x * scale + shift
+    scale = bn.running_var.add(bn.eps).rsqrt()
+    if bn.affine:
+        scale = scale * bn.weight
+    shift = -bn.running_mean * scale
+    if bn.affine:
+        shift = shift + bn.bias
+    return scale, shift
+
+
+@torch.no_grad()
+def _fuse_bn_into_next(hidden_layers, head):
+    """
+    Fold the (eval mode) batch norm layers of a Linear -> LeakyReLU -> BatchNorm1d stack 
+    into the linear layer that follows each of them (the next hidden layer, or the `head`), 
+    and replace the batch norm layers with nn.Identity.
+    """
+    pending = None
+    for i, layer in enumerate(hidden_layers):
+        if isinstance(layer, nn.BatchNorm1d):
+            pending = _bn_affine(layer)
+            hidden_layers[i] = nn.Identity()
+        elif isinstance(layer, nn.Linear) and pending is not None:
+            _fold_input_affine(layer, *pending)
+            pending = None
+    if pending is not None:
+        _fold_input_affine(head, *pending)
+
+
+def _fold_input_affine(linear, scale, shift):
+    # W (x * scale + shift) + b = (W * scale) x + (W shift + b)
+    if linear.bias is None:
+        linear.bias = nn.Parameter(torch.zeros_like(linear.weight[:, 0]))
+    linear.bias.add_(linear.weight @ shift)
+    linear.weight.mul_(scale)
+
+
 class Encoder(nn.Module):
     """
     Encoder class for a Variational Autoencoder (VAE).
     
     The Encoder class is responsible for taking input data and generating the mean and
     log variance for the latent space representation.
+
+    If `use_compile` is True, the forward pass is compiled with torch.compile, so that the linear, 
+    activation and batch norm layers are fused into fewer kernels (the first batches are slower while 
+    the graph is being compiled).
+
+    If `amp_dtype` is set (e.g. torch.bfloat16), the forward pass runs in mixed precision 
+    with torch.autocast; the outputs are cast back to the dtype of the input. In that case the hidden 
+    layer widths are also rounded up to multiples of 8, so that the half precision matrix multiplications 
+    can use tensor cores (the extra units are regular trainable units; input and output sizes are unchanged).
     """
-    def __init__(self, input_dim, hidden_dims, latent_dim):
+    def __init__(self, input_dim, hidden_dims, latent_dim, use_compile=False, amp_dtype=None):
         super(Encoder, self).__init__()
+        self.amp_dtype = amp_dtype
+        if amp_dtype is not None:
+            hidden_dims = [_round_up(h) for h in hidden_dims]
 
-        self.LeakyReLU = nn.LeakyReLU(0.2)
-        
+        # each hidden layer gets its own activation module (a single shared instance 
+        # would be registered once, but called at several places of the graph)
         hidden_layers = []
         
         hidden_layers.append(nn.Linear(input_dim, hidden_dims[0]))
         nn.init.xavier_uniform_(hidden_layers[-1].weight)
-        hidden_layers.append(self.LeakyReLU)
+        hidden_layers.append(nn.LeakyReLU(0.2))
         hidden_layers.append(nn.BatchNorm1d(hidden_dims[0]))
 
         for i in range(len(hidden_dims)-1):
             hidden_layers.append(nn.Linear(hidden_dims[i], hidden_dims[i+1]))
             nn.init.xavier_uniform_(hidden_layers[-1].weight)
-            hidden_layers.append(self.LeakyReLU)
+            hidden_layers.append(nn.LeakyReLU(0.2))
             hidden_layers.append(nn.BatchNorm1d(hidden_dims[i+1]))
 
         self.hidden_layers = nn.Sequential(*hidden_layers)
         
-        self.FC_mean  = nn.Linear(hidden_dims[-1], latent_dim)
-        nn.init.xavier_uniform_(self.FC_mean.weight)
-        self.FC_var   = nn.Linear(hidden_dims[-1], latent_dim)
-        nn.init.xavier_uniform_(self.FC_var.weight)
+        # the mean and log variance heads share their input: compute both with a single linear layer, 
+        # whose first/second half of outputs are the mean/log variance (each half initialized separately)
+        self.FC_head = nn.Linear(hidden_dims[-1], 2 * latent_dim)
+        with torch.no_grad():
+            nn.init.xavier_uniform_(self.FC_head.weight[:latent_dim])
+            nn.init.xavier_uniform_(self.FC_head.weight[latent_dim:])
+
+        if use_compile:
+            _compile_forward(self)
+
+    __getstate__ = _getstate_eager
+
+    def fuse_bn(self):
+        """
+        Fold the batch norm layers into the following linear layers, for faster inference.
+
+        Uses the running statistics, so the module must be in eval mode. This modifies the module in place 
+        and removes the batch norm layers: the fused module is meant for inference only, and should not be 
+        trained further.
+
+        Returns:
+            Encoder: The module itself.
+        """
+        if self.training:
+            raise ValueError("fuse_bn requires the module to be in eval mode, call .eval() first")
+        _fuse_bn_into_next(self.hidden_layers, self.FC_head)
+        return self
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints with separate FC_mean/FC_var layers: stack them into FC_head
+        if prefix + "FC_mean.weight" in state_dict and prefix + "FC_head.weight" not in state_dict:
+            for name in ["weight", "bias"]:
+                state_dict[prefix + "FC_head." + name] = torch.cat(
+                    [state_dict.pop(prefix + "FC_mean." + name), state_dict.pop(prefix + "FC_var." + name)])
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
         
     def forward(self, x):
         """
@@ -51,9 +177,11 @@ class Encoder(nn.Module):
             mean (torch.Tensor): The mean of the latent space representation.
             log_var (torch.Tensor): The log variance of the latent space representation.
         """
-        h_       = self.hidden_layers(x)
-        mean     = self.FC_mean(h_)
-        log_var  = self.FC_var(h_)
+        with _autocast(x, self.amp_dtype):
+            h_       = self.hidden_layers(x)
+            mean, log_var = self.FC_head(h_).chunk(2, dim=-1)
+        if self.amp_dtype is not None:
+            mean, log_var = mean.to(x.dtype), log_var.to(x.dtype)
         return mean, log_var
     
     
@@ -63,23 +191,28 @@ class Decoder(nn.Module):
     
     The Decoder class is responsible for taking the latent space representation and
     generating the reconstructed output data.
+
+    If `use_compile` is True, the forward pass is compiled with torch.compile, and if `amp_dtype` 
+    is set, it runs in mixed precision with hidden layer widths padded to multiples of 8 (see Encoder).
     """
-    def __init__(self, latent_dim, hidden_dims, output_dim):
+    def __init__(self, latent_dim, hidden_dims, output_dim, use_compile=False, amp_dtype=None):
         super(Decoder, self).__init__()
+        self.amp_dtype = amp_dtype
+        if amp_dtype is not None:
+            hidden_dims = [_round_up(h) for h in hidden_dims]
 
-        self.LeakyReLU = nn.LeakyReLU(0.2)
-
+        # one activation module per hidden layer (see Encoder)
         hidden_layers = []
 
         hidden_layers.append(nn.Linear(latent_dim, hidden_dims[0]))
         nn.init.xavier_uniform_(hidden_layers[-1].weight)
-        hidden_layers.append(self.LeakyReLU)
+        hidden_layers.append(nn.LeakyReLU(0.2))
         hidden_layers.append(nn.BatchNorm1d(hidden_dims[0]))
 
         for i in range(len(hidden_dims) - 1):
             hidden_layers.append(nn.Linear(hidden_dims[i], hidden_dims[i + 1]))
             nn.init.xavier_uniform_(hidden_layers[-1].weight)
-            hidden_layers.append(self.LeakyReLU)
+            hidden_layers.append(nn.LeakyReLU(0.2))
             hidden_layers.append(nn.BatchNorm1d(hidden_dims[i+1]))
 
         self.hidden_layers = nn.Sequential(*hidden_layers)
@@ -87,6 +220,24 @@ class Decoder(nn.Module):
         self.FC_output = nn.Linear(hidden_dims[-1], output_dim)
         nn.init.xavier_uniform_(self.FC_output.weight)
 
+        if use_compile:
+            _compile_forward(self)
+
+    __getstate__ = _getstate_eager
+
+    def fuse_bn(self):
+        """
+        Fold the batch norm layers into the following linear layers, for faster inference 
+        (in place, eval mode only; see Encoder.fuse_bn).
+
+        Returns:
+            Decoder: The module itself.
+        """
+        if self.training:
+            raise ValueError("fuse_bn requires the module to be in eval mode, call .eval() first")
+        _fuse_bn_into_next(self.hidden_layers, self.FC_output)
+        return self
+
     def forward(self, x):
         """
         Performs a forward pass through the Decoder network.
@@ -97,8 +248,11 @@ class Decoder(nn.Module):
         Returns:
             x_hat (torch.Tensor): The reconstructed output tensor.
         """
-        h = self.hidden_layers(x)
-        x_hat = torch.sigmoid(self.FC_output(h))
+        with _autocast(x, self.amp_dtype):
+            h = self.hidden_layers(x)
+            x_hat = torch.sigmoid(self.FC_output(h))
+        if self.amp_dtype is not None:
+            x_hat = x_hat.to(x.dtype)
         return x_hat
     
 
@@ -109,7 +263,7 @@ class MLP(nn.Module):
     The MLP class is a simple feed-forward neural network that can be used for regression
     when `output_dim` is set to 1 or for classification when `output_dim` is greater than 1.
     """
-    def __init__(self, input_dim, hidden_dim, output_dim):
+    def __init__(self, input_dim, hidden_dim, output_dim, use_compile=False, amp_dtype=None):
         """
         Initializes the MLP class with the given input dimension, output dimension, and hidden layer size.
         
@@ -117,14 +271,45 @@ class MLP(nn.Module):
             input_dim (int): The input dimension.
             hidden_dim (int, optional): The size of the hidden layer. Default is 32.
             output_dim (int): The output dimension. Set to 1 for regression tasks, and > 1 for classification tasks.
+            use_compile (bool, optional): Whether to compile the forward pass with torch.compile. Default is False.
+            amp_dtype (torch.dtype, optional): If set (e.g. torch.bfloat16), run the forward pass in mixed precision 
+                with torch.autocast. The output is cast back to the dtype of the input, and the hidden layer size 
+                is rounded up to a multiple of 8 (tensor core alignment). Default is None.
         """
         super(MLP, self).__init__()
+        self.amp_dtype = amp_dtype
+        if amp_dtype is not None:
+            hidden_dim = _round_up(hidden_dim)
         self.layer_1 = nn.Linear(input_dim, hidden_dim)
         self.layer_out = nn.Linear(hidden_dim, output_dim) if output_dim > 1 else nn.Linear(hidden_dim, 1, bias=False)
         self.relu = nn.ReLU() 
         self.dropout = nn.Dropout(p=0.1)
         self.batchnorm = nn.BatchNorm1d(hidden_dim)
 
+        if use_compile:
+            _compile_forward(self)
+
+    __getstate__ = _getstate_eager
+
+    @torch.no_grad()
+    def fuse_bn(self):
+        """
+        Fold the batch norm layer into the preceding linear layer, for faster inference 
+        (in place, eval mode only; see Encoder.fuse_bn).
+
+        Returns:
+            MLP: The module itself.
+        """
+        if self.training:
+            raise ValueError("fuse_bn requires the module to be in eval mode, call .eval() first")
+        if isinstance(self.batchnorm, nn.BatchNorm1d):
+            # scale * (W x + b) + shift = (scale * W) x + (scale * b + shift)
+            scale, shift = _bn_affine(self.batchnorm)
+            self.layer_1.weight.mul_(scale.unsqueeze(1))
+            self.layer_1.bias.mul_(scale).add_(shift)
+            self.batchnorm = nn.Identity()
+        return self
+
     def forward(self, x):
         """
         Performs a forward pass through the MLP network.
@@ -135,11 +320,15 @@ class MLP(nn.Module):
         Returns:
             x (torch.Tensor): The output tensor after passing through the MLP network.
         """
-        x = self.layer_1(x)
-        x = self.batchnorm(x)
-        x = self.relu(x)
-        x = self.dropout(x)
-        x = self.layer_out(x)
+        dtype = x.dtype
+        with _autocast(x, self.amp_dtype):
+            x = self.layer_1(x)
+            x = self.batchnorm(x)
+            x = self.relu(x)
+            x = self.dropout(x)
+            x = self.layer_out(x)
+        if self.amp_dtype is not None:
+            x = x.to(dtype)
         return x
 
 
@@ -187,6 +376,8 @@ class CNN(nn.Module):
 
         This CNN has a single convolutional layer followed by batch normalization,
         ReLU activation, dropout, and another convolutional layer as output.
+        Both convolutions have a kernel size of 1 over a sequence of length 1, which is 
+        a linear layer; they are therefore implemented as nn.Linear layers.
 
         Args:
             input_dim (int): The number of input dimensions or channels.
@@ -195,39 +386,43 @@ class CNN(nn.Module):
         """
         super().__init__()
 
-        self.layer_1 = nn.Conv1d(input_dim, hidden_dim, kernel_size=1)
+        self.layer_1 = nn.Linear(input_dim, hidden_dim)
         self.batchnorm = nn.BatchNorm1d(hidden_dim)
         self.relu = nn.ReLU()
         self.dropout = nn.Dropout(p=0.1)
-        self.layer_out = nn.Conv1d(hidden_dim, output_dim, kernel_size=1)
+        self.layer_out = nn.Linear(hidden_dim, output_dim)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints of the earlier Conv1d layers store weights of shape (out, in, 1)
+        for name in ["layer_1.weight", "layer_out.weight"]:
+            weight = state_dict.get(prefix + name)
+            if weight is not None and weight.dim() == 3:
+                state_dict[prefix + name] = weight.squeeze(-1)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, x):
         """
         Define the forward pass of the CNN.
 
-        The input tensor is passed through each layer of the network in sequence.
-        The input tensor is first unsqueezed to add an extra dimension, then passed through
-        the first convolutional layer, batch normalization, ReLU activation, dropout,
-        and finally through the output convolutional layer before being squeezed back.
+        The input tensor is passed through each layer of the network in sequence:
+        the first (1x1) convolutional layer, batch normalization, ReLU activation, dropout,
+        and finally the output (1x1) convolutional layer.
 
         Args:
             x (Tensor): A tensor of shape (N, C), where N is the batch size and C is the number of channels.
         Returns:
             Tensor: The output tensor of shape (N, C) after passing through the CNN.
         """
-        # (N, C) -> (N, C, L) -> (N, C).
-        x = x.unsqueeze(-1)
         x = self.layer_1(x)
         x = self.batchnorm(x)
         x = self.relu(x)
         x = self.dropout(x)
         x = self.layer_out(x)
-        x = x.squeeze(-1)
         return x
 
 
 class GCNN(nn.Module):
-    def __init__(self, input_dim, hidden_dim, output_dim):
+    def __init__(self, input_dim, hidden_dim, output_dim, use_compile=False):
         super().__init__()
         """
         Initialize the GCNN model.
@@ -239,14 +434,19 @@ class GCNN(nn.Module):
             input_dim (int): The number of input dimensions or features.
             hidden_dim (int): The number of hidden dimensions or features after the first graph convolutional layer.
             output_dim (int): The number of output dimensions or features after the second graph convolutional layer.
+            use_compile (bool, optional): Whether to compile the forward pass with torch.compile. Default is False.
         """
         self.layer_1 = gnn.GraphConv(input_dim, hidden_dim)
         self.relu_1 = nn.ReLU()
         self.layer_2 = gnn.GraphConv(hidden_dim, output_dim)
         self.relu_2 = nn.ReLU()
-        self.aggregation = gnn.aggr.SumAggregation()
 
-    def forward(self, x, edge_index, batch):
+        if use_compile:
+            _compile_forward(self)
+
+    __getstate__ = _getstate_eager
+
+    def forward(self, x, edge_index, batch, num_graphs=None):
         """
         Define the forward pass of the GCNN.
 
@@ -257,6 +457,8 @@ class GCNN(nn.Module):
             x (Tensor): Node feature matrix with shape [num_nodes, input_dim].
             edge_index (LongTensor): The edge indices in COO format with shape [2, num_edges].
             batch (LongTensor): The batch vector which assigns each node to a specific example in the batch.
+            num_graphs (int, optional): The number of graphs in the batch (e.g. `Batch.num_graphs`). If None, it is 
+                computed from `batch`, which requires a device synchronization (and a graph break when compiled).
 
         Returns:
             Tensor: The output tensor after processing through the GCNN, with shape [num_nodes, output_dim].
@@ -265,5 +467,9 @@ class GCNN(nn.Module):
         x = self.relu_1(x)
         x = self.layer_2(x, edge_index)
         x = self.relu_2(x)
-        x = self.aggregation(x, batch)
-        return x
+        # sum the node features per graph (a single index_add over the batch vector)
+        if batch is None:
+            return x.sum(dim=0, keepdim=True)
+        if num_graphs is None:
+            num_graphs = int(batch.max()) + 1
+        return x.new_zeros(num_graphs, x.size(1)).index_add(0, batch, x)
@@ -6,16 +6,17 @@ from umap import UMAP
 import seaborn as sns
 import matplotlib.pyplot as plt
 import matplotlib
+from matplotlib.patches import Patch
 from sklearn.decomposition import PCA
-from sklearn.metrics import balanced_accuracy_score, f1_score, cohen_kappa_score, classification_report
-from sklearn.metrics import mean_squared_error, r2_score
-from scipy.stats import pearsonr
+from sklearn.metrics import classification_report
 
 from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
 from sklearn.svm import SVC, SVR
-from sklearn.feature_selection import SelectFromModel
 from sklearn.feature_selection import mutual_info_regression, mutual_info_classif
 from sklearn.model_selection import KFold, cross_val_score, GridSearchCV
+from joblib import Parallel, delayed
+
+from .modules import _bn_affine
 
 def plot_dim_reduced(matrix, labels, method='pca', color_type='categorical', scatter_kwargs=None, legend_kwargs=None, figsize=(10, 8)):
     """
@@ -40,10 +41,19 @@ def plot_dim_reduced(matrix, labels, method='pca', color_type='categorical', sca
     legend_kwargs = legend_kwargs if legend_kwargs else {}
 
     # Compute transformation
+    # (only two components are needed: use a randomized SVD for PCA, in single precision)
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
     if method.lower() == 'pca':
-        transformer = PCA(n_components=2)
+        transformer = PCA(n_components=2, svd_solver='randomized', random_state=0)
     elif method.lower() == 'umap':
-        transformer = UMAP(n_components=2)
+        # start the embedding optimization from the first two principal components 
+        # (scaled to the coordinate range of UMAP's own initializations), rather than a spectral layout
+        init = PCA(n_components=2, svd_solver='randomized', random_state=0).fit_transform(matrix)
+        max_abs = np.abs(init).max()
+        if max_abs > 0:
+            init = init / max_abs * 10
+        transformer = UMAP(n_components=2, n_neighbors=min(15, matrix.shape[0] - 1), init=init, 
+                           low_memory=True, n_jobs=-1)
     else:
         raise ValueError("Invalid method. Expected 'pca' or 'umap'")
         
@@ -52,23 +62,32 @@ def plot_dim_reduced(matrix, labels, method='pca', color_type='categorical', sca
     # Create a pandas DataFrame for easier plotting
     transformed_df = pd.DataFrame(transformed_matrix, columns=[f"{method.upper()}1", f"{method.upper()}2"])
 
-    labels = [-1 if pd.isnull(x) or x in {'nan', 'None'} else x for x in labels]
+    missing = np.array([pd.isnull(x) or x in {'nan', 'None'} for x in labels], dtype=bool)
+    labels = [-1 if m else x for x, m in zip(labels, missing)]
 
     # Add the labels to the DataFrame
     transformed_df["Label"] = labels
 
     if color_type == 'categorical':
-        unique_labels = sorted(set(labels))
-        colormap = matplotlib.cm.get_cmap("tab20", len(unique_labels))
+        # missing labels are not a class: they are drawn in grey, with their own legend entry
+        label_series = pd.Series(labels, dtype=object).mask(missing)
+        unique_labels = sorted(pd.unique(label_series.dropna()))
+        colormap = plt.get_cmap("tab20", max(1, len(unique_labels)))
         
-        for i, label in enumerate(unique_labels):
-            plt.scatter(
-                transformed_df[transformed_df["Label"] == label][f"{method.upper()}1"],
-                transformed_df[transformed_df["Label"] == label][f"{method.upper()}2"],
-                color=colormap(i),
-                label=label,
-                **scatter_kwargs
-            )
+        # draw all points in a single scatter call, colored by the code of their label, 
+        # and build the legend entries for the labels separately
+        codes = pd.Categorical(label_series, categories=unique_labels).codes
+        colors = colormap(codes)
+        colors[codes == -1] = matplotlib.colors.to_rgba('lightgrey')
+        plt.scatter(
+            transformed_df[f"{method.upper()}1"],
+            transformed_df[f"{method.upper()}2"],
+            color=colors,
+            **scatter_kwargs
+        )
+        handles = [Patch(color=colormap(i), label=label) for i, label in enumerate(unique_labels)]
+        if (codes == -1).any():
+            handles.append(Patch(color='lightgrey', label='NA'))
         if method.lower() == 'pca':
             plt.xlabel(f"PC1 (explained variance: {transformer.explained_variance_ratio_[0]*100:.2f}%)", fontsize=14)
             plt.ylabel(f"PC2 (explained variance: {transformer.explained_variance_ratio_[1]*100:.2f}%)", fontsize=14)
@@ -77,7 +96,7 @@ def plot_dim_reduced(matrix, labels, method='pca', color_type='categorical', sca
             plt.ylabel(f"{method.upper()} Dimension 2", fontsize=14)
 
         plt.title(f"{method.upper()} Scatter Plot with Colored Labels", fontsize=18)
-        plt.legend(title="Labels", **legend_kwargs)
+        plt.legend(handles=handles, title="Labels", **legend_kwargs)
     elif color_type == 'numerical':
         sc = plt.scatter(transformed_df[f"{method.upper()}1"], transformed_df[f"{method.upper()}2"], 
                          c=labels, **scatter_kwargs)
@@ -102,16 +121,22 @@ def plot_scatter(true_values, predicted_values):
     true_values = true_values[not_nan_indices]
     predicted_values = predicted_values[not_nan_indices]
 
-    # Calculate correlation coefficient
-    corr, _ = pearsonr(true_values, predicted_values)
+    # Calculate the regression line (ordinary least squares) and the correlation coefficient 
+    # from the same centered sums
+    dx = true_values - true_values.mean()
+    dy = predicted_values - predicted_values.mean()
+    sxx, syy, sxy = np.dot(dx, dx), np.dot(dy, dy), np.dot(dx, dy)
+    m = sxy / sxx
+    b = predicted_values.mean() - m * true_values.mean()
+    corr = sxy / np.sqrt(sxx * syy)
     corr_text = f"Pearson r: {corr:.2f}"
     
     # Generate scatter plot
     plt.scatter(true_values, predicted_values, alpha=0.5)
     
-    # Add regression line
-    m, b = np.polyfit(true_values, predicted_values, 1)
-    plt.plot(true_values, m*true_values + b, color='red')
+    # Add regression line (a straight line only needs its end points)
+    x_range = np.array([true_values.min(), true_values.max()])
+    plt.plot(x_range, m*x_range + b, color='red')
     
     # Add correlation text
     plt.text(min(true_values), max(predicted_values), corr_text, fontsize=12, ha='left', va='top')
@@ -138,12 +163,24 @@ def split_by_median(v):
     return ((v - torch.nanmedian(v)) > 0).float()
     
 def evaluate_classifier(y_true, y_pred, print_report = False):
-    # Balanced accuracy
-    balanced_acc = balanced_accuracy_score(y_true, y_pred)
+    # All metrics are derived from a single confusion matrix over the union of the observed labels 
+    # (same definitions as sklearn's balanced_accuracy_score, f1_score(average='macro', zero_division=0) 
+    # and cohen_kappa_score), instead of one pass over the labels per metric
+    y_true, y_pred = np.asarray(y_true).ravel(), np.asarray(y_pred).ravel()
+    labels, codes = np.unique(np.concatenate([y_true, y_pred]), return_inverse=True)
+    n_classes, n = len(labels), len(y_true)
+    cm = np.bincount(codes[:n] * n_classes + codes[n:], minlength=n_classes ** 2).reshape(n_classes, n_classes)
+    tp, true_counts, pred_counts = np.diag(cm), cm.sum(axis=1), cm.sum(axis=0)
+    # Balanced accuracy: mean recall over the classes present in y_true
+    present = true_counts > 0
+    balanced_acc = np.mean(tp[present] / true_counts[present])
     # F1 score (macro)
-    f1 = f1_score(y_true, y_pred, average='macro', zero_division=0)
+    f1_denominator = true_counts + pred_counts
+    f1 = np.mean(np.divide(2 * tp, f1_denominator, out=np.zeros(n_classes), where=f1_denominator > 0))
     # Cohen's Kappa
-    kappa = cohen_kappa_score(y_true, y_pred)
+    observed = tp.sum() / n
+    expected = np.dot(true_counts, pred_counts) / n ** 2
+    kappa = (observed - expected) / (1 - expected) if expected != 1 else np.nan
     # Full classification report
     if print_report:
         print("\nClassification Report:")
@@ -152,9 +189,21 @@ def evaluate_classifier(y_true, y_pred, print_report = False):
     return {"balanced_acc": balanced_acc, "f1_score": f1, "kappa": kappa}
 
 def evaluate_regressor(y_true, y_pred):
-    mse = mean_squared_error(y_true, y_pred)
-    r2 = r2_score(y_true, y_pred)
-    pearson_corr, _ = pearsonr(y_true, y_pred)
+    # compute all metrics from the residuals and the centered values, 
+    # in a single numpy pass instead of one pass per metric function
+    y_true = np.asarray(y_true, dtype=np.float64).ravel()
+    y_pred = np.asarray(y_pred, dtype=np.float64).ravel()
+    residuals = y_pred - y_true
+    ss_res = np.dot(residuals, residuals)
+    mse = ss_res / len(y_true)
+    true_centered = y_true - y_true.mean()
+    ss_tot = np.dot(true_centered, true_centered)
+    if ss_tot == 0:
+        # constant y_true, same convention as sklearn's r2_score
+        r2 = 1.0 if ss_res == 0 else 0.0
+    else:
+        r2 = 1 - ss_res / ss_tot
+    pearson_corr = np.corrcoef(y_true, y_pred)[0, 1]
     return {"mse": mse, "r2": r2, "pearson_corr": pearson_corr}
 
 def evaluate_wrapper(y_pred_dict, dataset):
@@ -263,7 +312,28 @@ def evaluate_baseline_performance(train_dataset, test_dataset, variable_name, n_
     return pd.DataFrame(metrics_list)
 
 
-def remove_batch_associated_variables(data, variable_types, target_dict, batch_dict = None, mi_threshold=0.1):
+def _important_features_mask(X, y, variable_type):
+    # fit a random forest on the samples with a known label, and select the features 
+    # with an importance of at least the mean importance (same as SelectFromModel's default threshold)
+    not_missing = ~np.isnan(y)
+    if variable_type == "categorical":
+        clf = RandomForestClassifier(n_jobs=1)
+    else:  # numerical
+        clf = RandomForestRegressor(n_jobs=1)
+    clf = clf.fit(X[not_missing], y[not_missing])
+    importances = clf.feature_importances_
+    return importances >= importances.mean()
+
+
+def _mutual_information(X, y, variable_type):
+    # mutual information of each feature with a variable, on the samples with a known label
+    not_missing = ~np.isnan(y)
+    if variable_type == "categorical":
+        return mutual_info_classif(X[not_missing], y[not_missing])
+    return mutual_info_regression(X[not_missing], y[not_missing])
+
+
+def remove_batch_associated_variables(data, variable_types, target_dict, batch_dict = None, mi_threshold=0.1, n_jobs=-1):
     """
     Filter the data matrix to keep only the columns that are predictive of the target variables 
     and not predictive of the batch variables.
@@ -275,57 +345,39 @@ def remove_batch_associated_variables(data, variable_types, target_dict, batch_d
         variable_types (dict): A dictionary of variable types (either "numerical" or "categorical").
         mi_threshold (float, optional): The mutual information threshold for a column to be considered predictive.
                                         Defaults to 0.1.
+        n_jobs (int, optional): Number of parallel jobs; the models of the different variables are fitted 
+                                in parallel. Defaults to -1 (all cores).
     
     Returns:
         pd.DataFrame: The filtered data matrix.
     """
-    # Convert target and batch tensors to numpy
-    target_dict_np = {k: v.numpy() for k, v in target_dict.items()}
-
-    important_features = set()
-
-    # Find important features for target variables
-    for var_name, target in target_dict_np.items():
-        # Skip if all values are missing
-        if np.all(np.isnan(target)):
-            continue
-            
-        # Subset data and target where target is not missing
-        not_missing = ~np.isnan(target)
-        data_sub = data[not_missing]
-        target_sub = target[not_missing]
-
-        if variable_types[var_name] == "categorical":
-            clf = RandomForestClassifier()
-        else:  # numerical
-            clf = RandomForestRegressor()
-            
-        clf = clf.fit(data_sub, target_sub)
-        model = SelectFromModel(clf, prefit=True)
-        important_features.update(data.columns[model.get_support()])
-
-    if batch_dict is not None:
-        batch_dict_np = {k: v.numpy() for k, v in batch_dict.items()}
+    # work on the numpy matrix (no data frame copies when subsetting samples), 
+    # and keep track of the selected features with a boolean mask over the columns
+    data_np = data.to_numpy()
+    important_features = np.zeros(data.shape[1], dtype=bool)
+
+    # variables with at least one known value (variables with all values missing are skipped)
+    targets = {k: v.numpy() for k, v in target_dict.items()}
+    targets = {k: v for k, v in targets.items() if not np.all(np.isnan(v))}
+    batches = {k: v.numpy() for k, v in batch_dict.items()} if batch_dict is not None else {}
+    batches = {k: v for k, v in batches.items() if not np.all(np.isnan(v))}
+
+    # the variables are independent of each other: fit them in parallel
+    # (one core per model, to avoid oversubscription)
+    n_tasks = len(targets) + len(batches)
+    with Parallel(n_jobs=n_jobs if n_tasks > 1 else 1) as parallel:
+        # Find important features for target variables
+        masks = parallel(delayed(_important_features_mask)(data_np, y, variable_types[k]) for k, y in targets.items())
         # Compute mutual information for batch variables
-        for var_name, batch in batch_dict_np.items():
-            # Skip if all values are missing
-            if np.all(np.isnan(batch)):
-                continue
+        mis = parallel(delayed(_mutual_information)(data_np, y, variable_types[k]) for k, y in batches.items())
 
-            # Subset data and batch where batch is not missing
-            not_missing = ~np.isnan(batch)
-            data_sub = data[not_missing]
-            batch_sub = batch[not_missing]
+    for mask in masks:
+        important_features |= mask
+    for mi in mis:
+        # Remove features with high mutual information with batch variables
+        important_features &= mi <= mi_threshold
 
-            if variable_types[var_name] == "categorical":
-                mi = mutual_info_classif(data_sub, batch_sub)
-            else:  # numerical
-                mi = mutual_info_regression(data_sub, batch_sub)
-
-            # Remove features with high mutual information with batch variables
-            important_features -= set(data.columns[mi > mi_threshold])
-
-    return data[list(important_features)]
+    return data.iloc[:, important_features]
 
 
 def get_important_features(model, var, top=20):
@@ -380,4 +432,40 @@ def print_summary_stats(dataset):
             median_val = np.nanmedian(tensor)
             mean_val = np.nanmean(tensor)
             print(f"Numerical Variable Summary: Median = {median_val}, Mean = {mean_val}")
-        print("------")
\ No newline at end of file
+        print("------")
+
+@torch.no_grad()
+def batched_mlp_forward(mlps, x):
+    """
+    Run the same input through several MLPs (e.g. models from different folds or bootstrap samples) 
+    with one batched matrix multiplication per layer instead of one forward call per model.
+
+    The weights of the models are stacked along a new leading dimension; batch norm (running statistics) 
+    is folded into the first linear layer. All models must have the same layer sizes and be in eval mode.
+
+    Args:
+        mlps (list of MLP): The models.
+        x (torch.Tensor): The input data tensor (batch_size, input_dim).
+
+    Returns:
+        torch.Tensor: The outputs of all models, of shape (n_models, batch_size, output_dim).
+    """
+    if any(mlp.training for mlp in mlps):
+        raise ValueError("batched_mlp_forward requires all models to be in eval mode")
+    w1, b1 = [], []
+    for mlp in mlps:
+        w, b = mlp.layer_1.weight, mlp.layer_1.bias
+        bn = mlp.batchnorm
+        if isinstance(bn, torch.nn.BatchNorm1d):
+            # same folding as MLP.fuse_bn, without modifying the model
+            scale, shift = _bn_affine(bn)
+            w, b = w * scale.unsqueeze(1), b * scale + shift
+        w1.append(w)
+        b1.append(b)
+    w1, b1 = torch.stack(w1), torch.stack(b1)
+    w2 = torch.stack([mlp.layer_out.weight for mlp in mlps])
+    b2 = torch.stack([mlp.layer_out.bias if mlp.layer_out.bias is not None else torch.zeros_like(mlp.layer_out.weight[:, 0]) 
+                      for mlp in mlps])
+
+    h = torch.relu(torch.einsum('koi,bi->kbo', w1, x) + b1.unsqueeze(1))
+    return torch.einsum('koi,kbi->kbo', w2, h) + b2.unsqueeze(1)
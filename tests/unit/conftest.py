@@ -0,0 +1,20 @@
+import pytest
+import torch
+from torch import nn
+
+
+@pytest.fixture
+def randomize_batchnorm():
+    """Give all batch norm layers of a module non-trivial running statistics and affine parameters, 
+    and put the module in eval mode."""
+    def randomize(module, seed=0):
+        generator = torch.Generator().manual_seed(seed)
+        for m in module.modules():
+            if isinstance(m, nn.BatchNorm1d):
+                with torch.no_grad():
+                    m.running_mean.copy_(torch.randn(m.num_features, generator=generator))
+                    m.running_var.copy_(torch.rand(m.num_features, generator=generator) * 1.5 + 0.5)
+                    m.weight.copy_(torch.randn(m.num_features, generator=generator))
+                    m.bias.copy_(torch.randn(m.num_features, generator=generator))
+        return module.eval()
+    return randomize
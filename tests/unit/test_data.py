@@ -0,0 +1,141 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+
+from flexynesis import data
+from flexynesis.data import MultiomicDataset, TripletMultiOmicDataset, read_data_matrix
+
+
+def _make_dataset(labels, seed=0):
+    torch.manual_seed(seed)
+    n = len(labels)
+    dat = {'gex': torch.randn(n, 6), 'cnv': torch.randn(n, 4)}
+    ann = {'y': torch.tensor(labels, dtype=torch.float32), 'age': torch.randn(n)}
+    features = {'gex': [f'g{i}' for i in range(6)], 'cnv': [f'c{i}' for i in range(4)]}
+    return MultiomicDataset(dat, ann, {'y': 'categorical', 'age': 'numerical'}, features, 
+                            [f's{i}' for i in range(n)], {})
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_triplets_skip_missing_labels(seed):
+    labels = [0, 1, 2, np.nan, 0, 1, -1, 2, 0, np.nan, 1, 2] * 3
+    triplets = TripletMultiOmicDataset(_make_dataset(labels), 'y', seed=seed)
+    y = np.array(labels)
+    known = ~np.isnan(y) & (y != -1)
+    anchors = np.arange(len(y))
+    pos, neg = triplets.pos_idx.numpy(), triplets.neg_idx.numpy()
+    # labelled anchors are only paired with labelled samples
+    assert known[pos[known]].all() and known[neg[known]].all()
+    assert (y[pos[known]] == y[known]).all() and (pos[known] != anchors[known]).all()
+    assert (y[neg[known]] != y[known]).all()
+    # unlabelled anchors are their own positive and negative
+    assert (pos[~known] == anchors[~known]).all() and (neg[~known] == anchors[~known]).all()
+
+
+@pytest.mark.parametrize("header", [
+    "gene,s1,s2,s3,s4",
+    ",s1,s2,s3,s4",
+    "gene,s1,s2,s3,s2",
+    "gene,s1,s1,s1.1,s1",
+])
+def test_read_data_matrix_matches_pandas(tmp_path, header):
+    fname = str(tmp_path / "gex.csv")
+    with open(fname, "w") as f:
+        f.write(header + "\ng1,1,2,3,4\ng2,5,,7,8\ng3,0.5,NA,-1,2e3\n")
+    df = read_data_matrix(fname)
+    expected = pd.read_csv(fname, index_col=0).astype(np.float32)
+    pd.testing.assert_frame_equal(df, expected, check_index_type=False, check_column_type=False)
+
+
+@pytest.mark.parametrize("index_type", [list, np.array, torch.tensor])
+def test_list_index_matches_int_index(index_type):
+    dataset = _make_dataset([0, 1, 2, 0, 1, 2, 0, 1])
+    indices = [5, 0, 3, 3]
+    dat, ann = dataset[index_type(indices)]
+    for x in dataset.dat.keys():
+        assert torch.equal(dat[x], torch.stack([dataset[i][0][x] for i in indices]))
+        assert torch.equal(dat[x], dataset.dat[x][indices])
+    for x in dataset.ann.keys():
+        assert torch.equal(ann[x], torch.stack([dataset[i][1][x] for i in indices]))
+
+
+def test_triplet_list_index_matches_int_index():
+    triplets = TripletMultiOmicDataset(_make_dataset([0, 1, 2, 0, 1, 2, 0, 1]), 'y', seed=0)
+    indices = [5, 0, 3, 3]
+    batch = triplets[indices]
+    samples = [triplets[i] for i in indices]
+    for part in range(4):
+        for x in batch[part].keys():
+            assert torch.equal(batch[part][x], torch.stack([sample[part][x] for sample in samples]))
+
+
+def test_default_dataloader_collates_samples():
+    dataset = _make_dataset([0, 1, 2, 0, 1, 2, 0, 1])
+    dat, ann = next(iter(torch.utils.data.DataLoader(dataset, batch_size=4)))
+    assert torch.equal(dat['gex'], dataset.dat['gex'][:4])
+    assert torch.equal(ann['y'], dataset.ann['y'][:4])
+    anchor, pos, neg, y = next(iter(torch.utils.data.DataLoader(TripletMultiOmicDataset(dataset, 'y'), batch_size=4)))
+    assert anchor['cnv'].shape == pos['cnv'].shape == neg['cnv'].shape == (4, 4)
+
+
+def test_triplet_invariants():
+    # class 3 has a single sample, which is then its own positive
+    labels = [0, 1, 2, 0, 1, 2, 0, 1, 0, 0, 3]
+    triplets = TripletMultiOmicDataset(_make_dataset(labels), 'y', seed=0)
+    y = np.array(labels)
+    anchors = np.arange(len(y))
+    draws = []
+    for epoch in range(5):
+        triplets.set_epoch(epoch)
+        pos, neg = triplets.pos_idx.numpy(), triplets.neg_idx.numpy()
+        assert (y[pos] == y).all()
+        assert (pos != anchors)[y != 3].all() and pos[y == 3] == anchors[y == 3]
+        assert (y[neg] != y).all()
+        draws.append(np.concatenate([pos, neg]))
+    assert any((draws[0] != d).any() for d in draws[1:])
+    # draws are reproducible for a given seed and epoch
+    other = TripletMultiOmicDataset(_make_dataset(labels), 'y', seed=0)
+    other.set_epoch(4)
+    assert torch.equal(other.pos_idx, triplets.pos_idx) and torch.equal(other.neg_idx, triplets.neg_idx)
+
+
+def test_quantize_round_trip():
+    dataset = _make_dataset([0, 1, 2, 0, 1, 2, 0, 1])
+    original = {x: v.clone() for x, v in dataset.dat.items()}
+    x = dataset._cat
+    zero = x.min(dim=0).values
+    scale = (x.max(dim=0).values - zero) / 255
+    dataset.quantize(zero, scale)
+    assert dataset._cat.dtype == torch.uint8
+    for x, s in dataset._slices.items():
+        # dequantized values are within half a quantization step of the original values
+        assert ((dataset.dat[x] - original[x]).abs() <= scale[s] / 2 + 1e-6).all()
+        assert torch.equal(dataset[[1, 4]][0][x], dataset.dat[x][[1, 4]])
+    assert dataset.get_dataset_stats()['feature_count in: gex'] == 6
+    with pytest.raises(TypeError):
+        dataset.dat['gex'] = original['gex']
+
+
+def test_read_data_matrix_cache(tmp_path, monkeypatch):
+    fname = str(tmp_path / "gex.csv")
+    with open(fname, "w") as f:
+        f.write("gene,s1,s2,s3\ng1,1,2,3\ng2,5,,7\n")
+    df = read_data_matrix(fname, use_cache=True)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the csv file was parsed again")
+    # a cache hit does not parse the csv file
+    with monkeypatch.context() as m:
+        m.setattr(pd, "read_csv", fail)
+        m.setattr(data, "pacsv", None)
+        cached = read_data_matrix(fname, use_cache=True)
+    pd.testing.assert_frame_equal(cached, df)
+
+    # the cache is not used once the csv file is modified
+    with open(fname, "w") as f:
+        f.write("gene,s1,s2,s3\ng1,1,2,3\ng2,5,6,7\n")
+    os.utime(fname, (0, 0))
+    assert read_data_matrix(fname, use_cache=True).loc['g2', 's2'] == 6
@@ -0,0 +1,84 @@
+import io
+
+import pytest
+import torch
+from torch import nn
+
+from flexynesis.modules import Encoder, Decoder, MLP, GCNN
+
+
+@pytest.mark.parametrize("make_module, input_dim", [
+    (lambda: Encoder(10, [16, 8], 4), 10),
+    (lambda: Decoder(4, [8, 16], 10), 4),
+    (lambda: MLP(10, 16, 3), 10),
+])
+def test_fuse_bn_preserves_output(make_module, input_dim, randomize_batchnorm):
+    torch.manual_seed(0)
+    module = randomize_batchnorm(make_module())
+    x = torch.randn(8, input_dim)
+    with torch.no_grad():
+        # Encoder returns (mean, log_var), the other modules a single tensor
+        expected = torch.cat(module(x) if isinstance(module, Encoder) else [module(x)], dim=-1)
+        fused = module.fuse_bn()
+        out = torch.cat(fused(x) if isinstance(fused, Encoder) else [fused(x)], dim=-1)
+    assert not any(isinstance(m, nn.BatchNorm1d) for m in fused.modules())
+    assert torch.allclose(out, expected, atol=1e-5)
+
+
+def test_fuse_bn_requires_eval_mode():
+    with pytest.raises(ValueError):
+        MLP(10, 16, 3).train().fuse_bn()
+
+
+@pytest.mark.parametrize("make_module, input_dim", [
+    (lambda: Encoder(10, [16, 8], 4), 10),
+    (lambda: Decoder(4, [8, 16], 10), 4),
+    (lambda: MLP(10, 16, 3), 10),
+])
+def test_outer_autocast_applies_without_amp_dtype(make_module, input_dim):
+    module = make_module().eval()
+    x = torch.randn(8, input_dim)
+    with torch.no_grad(), torch.autocast('cpu', dtype=torch.bfloat16):
+        out = module(x)
+    for o in (out if isinstance(out, tuple) else (out,)):
+        assert o.dtype == torch.bfloat16
+
+
+def test_amp_dtype_casts_outputs_back():
+    module = MLP(10, 16, 3, amp_dtype=torch.bfloat16).eval()
+    with torch.no_grad():
+        assert module(torch.randn(8, 10)).dtype == torch.float32
+
+
+@pytest.mark.parametrize("has_module_compile", [True, False])
+@pytest.mark.parametrize("make_module", [
+    lambda: Encoder(10, [16, 8], 4, use_compile=True),
+    lambda: Decoder(4, [8, 16], 10, use_compile=True),
+    lambda: MLP(10, 16, 3, use_compile=True),
+    lambda: GCNN(10, 16, 3, use_compile=True),
+])
+def test_compiled_modules_can_be_saved(make_module, has_module_compile, monkeypatch):
+    if not has_module_compile:
+        # torch < 2.2: the bound forward method is replaced with its compiled version
+        monkeypatch.delattr(nn.Module, "compile", raising=False)
+    module = make_module()
+    buffer = io.BytesIO()
+    torch.save(module, buffer)
+    buffer.seek(0)
+    loaded = torch.load(buffer, weights_only=False)
+    assert "forward" not in loaded.__dict__
+    assert list(loaded.state_dict()) == list(module.state_dict())
+
+
+def test_gcnn_num_graphs():
+    torch.manual_seed(0)
+    gcnn = GCNN(3, 8, 4).eval()
+    x = torch.randn(7, 3)
+    edge_index = torch.tensor([[0, 1, 2, 3, 4, 5], [1, 0, 3, 2, 5, 6]])
+    batch = torch.tensor([0, 0, 1, 1, 2, 2, 2])
+    with torch.no_grad():
+        out = gcnn(x, edge_index, batch, num_graphs=3)
+        assert torch.allclose(out, gcnn(x, edge_index, batch))
+        # the node features are summed per graph
+        h = gcnn.relu_2(gcnn.layer_2(gcnn.relu_1(gcnn.layer_1(x, edge_index)), edge_index))
+        assert torch.allclose(out, torch.stack([h[batch == g].sum(0) for g in range(3)]))
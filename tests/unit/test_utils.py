@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+import torch
+from sklearn.metrics import balanced_accuracy_score, f1_score, cohen_kappa_score
+
+from flexynesis.modules import MLP
+from flexynesis.utils import evaluate_classifier, batched_mlp_forward
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_evaluate_classifier_matches_sklearn(seed):
+    rng = np.random.RandomState(seed)
+    y_true = rng.randint(0, 4, size=50)
+    # include a label that is only predicted, never observed
+    y_pred = rng.randint(0, 5, size=50)
+    metrics = evaluate_classifier(y_true, y_pred)
+    assert metrics["balanced_acc"] == pytest.approx(balanced_accuracy_score(y_true, y_pred))
+    assert metrics["f1_score"] == pytest.approx(f1_score(y_true, y_pred, average='macro', zero_division=0))
+    assert metrics["kappa"] == pytest.approx(cohen_kappa_score(y_true, y_pred))
+
+
+def test_evaluate_classifier_string_labels():
+    y_true = ['a', 'b', 'b', 'c', 'a']
+    y_pred = ['a', 'b', 'c', 'c', 'b']
+    metrics = evaluate_classifier(y_true, y_pred)
+    assert metrics["balanced_acc"] == pytest.approx(balanced_accuracy_score(y_true, y_pred))
+    assert metrics["f1_score"] == pytest.approx(f1_score(y_true, y_pred, average='macro', zero_division=0))
+    assert metrics["kappa"] == pytest.approx(cohen_kappa_score(y_true, y_pred))
+
+
+def test_batched_mlp_forward_matches_individual_models(randomize_batchnorm):
+    torch.manual_seed(0)
+    mlps = [randomize_batchnorm(MLP(10, 16, 3), seed=seed) for seed in range(3)]
+    x = torch.randn(8, 10)
+    with torch.no_grad():
+        expected = torch.stack([mlp(x) for mlp in mlps])
+        out = batched_mlp_forward(mlps, x)
+    assert out.shape == (3, 8, 3)
+    assert torch.allclose(out, expected, atol=1e-5)
+
+
+def test_batched_mlp_forward_requires_eval_mode():
+    mlps = [MLP(10, 16, 3).eval(), MLP(10, 16, 3).train()]
+    with pytest.raises(ValueError):
+        batched_mlp_forward(mlps, torch.randn(8, 10))